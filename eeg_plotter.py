@@ -1,14 +1,17 @@
-import pandas as pd
-import plotly.graph_objects as go
-from plotly.subplots import make_subplots
-import plotly.express as px
 import sys
 import os
+import json
 from pathlib import Path
-import dash
-from dash import dcc, html, Input, Output
 
 
+# Bump whenever the parsed data or sidecar layout changes, so caches
+# written by older versions are ignored instead of misread
+CACHE_VERSION = 2
+
+# System/trigger columns that are never loaded
+EXCLUDE_COLS = ['Trigger', 'Time_Offset', 'ADC_Status', 'ADC_Sequence',
+                'Event', 'X3_', 'Comments', 'CMF']
+
 
 class EEGPlotter:
     def __init__(self, csv_file):
@@ -16,57 +19,151 @@ class EEGPlotter:
         self.data = None
         self.channels = []
         self.sample_rate = 200
+        self.n_samples = 0
+        self.time_offset = 0.0
         
     def parse_eeg_csv(self):
         """Parse EEG/ECG CSV"""
+        import numpy as np
+        import pandas as pd
+        
         print(f"Loading {self.csv_file}...")
         
-        # Read the raw file to find the header
-        with open(self.csv_file, 'r') as f:
-            lines = f.readlines()
+        parquet_file = self.csv_file + '.parquet'
+        sidecar_file = self.csv_file + '.json'
+        
+        # Reuse the columnar cache when it is at least as new as the CSV
+        csv_mtime = os.path.getmtime(self.csv_file)
+        if (os.path.exists(parquet_file) and os.path.exists(sidecar_file)
+                and csv_mtime <= os.path.getmtime(parquet_file)
+                and csv_mtime <= os.path.getmtime(sidecar_file)):
+            # A truncated, corrupt or outdated cache falls through to a re-parse
+            try:
+                with open(sidecar_file, 'r') as f:
+                    sidecar = json.load(f)
+                
+                if (sidecar.get('version') == CACHE_VERSION
+                        and sidecar.get('exclude_cols') == EXCLUDE_COLS):
+                    data = pd.read_parquet(parquet_file)
+                    self.channels = sidecar['channels']
+                    self.sample_rate = sidecar['sample_rate']
+                    self.time_offset = sidecar['time_offset']
+                    self.data = data
+                    self.n_samples = len(self.data)
+                    return sidecar['metadata']
+            except (ImportError, OSError, ValueError, KeyError) as e:
+                print(f"Ignoring unreadable cache: {e}")
         
         # Extract metadata
         metadata = {}
         header_line_idx = -1
         
-        for i, line in enumerate(lines):
-            line = line.strip()
-            
-            # Extract sample frequency from metadata
-            if 'Sample_Frequency_(Hz)' in line:
-                try:
-                    self.sample_rate = float(line.split(',')[1])
-                    metadata['sample_rate'] = self.sample_rate
-                except:
-                    pass
-            
-            # Find the actual header line
-            if line.startswith('Time,') or line.startswith('Time\t'):
-                header_line_idx = i
-                break
+        # Stream the raw file line by line until the header is found
+        with open(self.csv_file, 'r') as f:
+            for i, line in enumerate(f):
+                line = line.strip()
+                
+                # Extract sample frequency from metadata
+                if 'Sample_Frequency_(Hz)' in line:
+                    try:
+                        self.sample_rate = float(line.split(',')[1])
+                        metadata['sample_rate'] = self.sample_rate
+                    except:
+                        pass
+                
+                # Find the actual header line
+                if line.startswith('Time,') or line.startswith('Time\t'):
+                    header_line_idx = i
+                    break
                 
         if header_line_idx == -1:
             raise ValueError("Could not find header line starting with 'Time'")
         
-        # Read the CSV starting from the header
-        self.data = pd.read_csv(self.csv_file, skiprows=header_line_idx, low_memory=False)
+        # Read only the header first so unused columns are never loaded
+        raw_columns = pd.read_csv(self.csv_file, skiprows=header_line_idx, nrows=0).columns
         
         # Clean column names
-        self.data.columns = [col.replace('**', '').replace(':', '_').strip() 
-                           for col in self.data.columns]
+        clean_names = dict(zip(raw_columns,
+                               raw_columns.str.replace('**', '', regex=False)
+                                          .str.replace(':', '_', regex=False)
+                                          .str.strip()))
         
         # Filter out system/trigger columns
-        exclude_cols = ['Trigger', 'Time_Offset', 'ADC_Status', 'ADC_Sequence', 
-                       'Event', 'X3_', 'Comments', 'CMF']
+        usecols = [col for col in raw_columns
+                   if clean_names[col] == 'Time'
+                   or (clean_names[col] not in EXCLUDE_COLS and clean_names[col])]
+        dtype = {col: np.float32 for col in usecols if clean_names[col] != 'Time'}
         
-        self.channels = [col for col in self.data.columns 
-                        if col != 'Time' and col not in exclude_cols and col.strip()]
+        # Read the CSV starting from the header, using the multi-threaded
+        # pyarrow parser when it is available
+        try:
+            import pyarrow as pa
+            from pyarrow import csv as pa_csv
+        except ImportError:
+            pa = None
         
+        if pa is not None:
+            table = pa_csv.read_csv(
+                self.csv_file,
+                read_options=pa_csv.ReadOptions(skip_rows=header_line_idx),
+                convert_options=pa_csv.ConvertOptions(
+                    include_columns=usecols,
+                    column_types={col: pa.float32() for col in dtype},
+                ),
+            )
+            self.data = table.to_pandas()
+        else:
+            self.data = pd.read_csv(self.csv_file, skiprows=header_line_idx,
+                                    usecols=usecols, dtype=dtype, engine='c')
+        self.data.columns = [clean_names[col] for col in self.data.columns]
+        
+        # When samples are uniformly spaced keep only the start time and rebuild
+        # the time axis from the sample rate instead of storing a Time column
+        time_values = self.data['Time'].values
+        self.n_samples = len(self.data)
+        self.time_offset = float(time_values[0]) if self.n_samples else 0.0
+        if 'sample_rate' not in metadata and self.n_samples > 1 and time_values[-1] > time_values[0]:
+            # Span over count, as single steps are rounded in the file
+            self.sample_rate = float((self.n_samples - 1) / (time_values[-1] - time_values[0]))
+        
+        # Keep the recorded timestamps if the rebuilt axis drifts by more than
+        # half a sample, e.g. because samples were dropped
+        rebuilt = self.time_offset + np.arange(self.n_samples) / self.sample_rate
+        if np.all(np.abs(rebuilt - time_values) <= 0.5 / self.sample_rate):
+            self.data.pop('Time')
+        else:
+            print("Time column is not uniformly sampled, keeping recorded timestamps")
+        
+        self.channels = [col for col in self.data.columns if col != 'Time']
+        
+        # Cache the parsed data so later loads skip CSV parsing; the sidecar
+        # is written last, and atomically, so its presence implies a complete
+        # Parquet file
+        try:
+            self.data.to_parquet(parquet_file, compression='zstd')
+            tmp_sidecar_file = sidecar_file + '.tmp'
+            with open(tmp_sidecar_file, 'w') as f:
+                json.dump({
+                    'version': CACHE_VERSION,
+                    'exclude_cols': EXCLUDE_COLS,
+                    'sample_rate': self.sample_rate,
+                    'channels': self.channels,
+                    'time_offset': self.time_offset,
+                    'metadata': metadata,
+                }, f)
+            os.replace(tmp_sidecar_file, sidecar_file)
+        except (ImportError, OSError) as e:
+            print(f"Could not write cache: {e}")
         
         return metadata
     
     def create_interactive_plot(self, max_channels=30):
         """Create an interactive multichannel plot"""
+        import numpy as np
+        import plotly.graph_objects as go
+        import plotly.express as px
+        from plotly_resampler import FigureResampler
+        from plotly_resampler.aggregation import MinMaxAggregator
 
         # Categorize channels
         channel_categories = self.categorize_channels()
@@ -83,86 +180,82 @@ class EEGPlotter:
             raise ValueError("No valid channels found to plot")
         
 
-        subplot_titles = []
-        for ch in channels_to_plot:
-            if ch in channel_categories['ecg']:
-                subplot_titles.append(f"{ch} (mV) - ECG")
-            elif ch in channel_categories['reference']:
-                subplot_titles.append(f"{ch} (Reference)")
-            else:
-                subplot_titles.append(f"{ch} (μV) - EEG")
-        
-        # Create subplots with shared x-axis
-        fig = make_subplots(
-            rows=n_channels, cols=1,
-            shared_xaxes=False,
-            vertical_spacing=0.015,
-            subplot_titles=subplot_titles,
-            specs=[[{"secondary_y": False}] for _ in range(n_channels)]
+        # Category lookup built once, so the trace loop does no list scans
+        category = {c: 'ecg' for c in channel_categories['ecg']}
+        category.update({c: 'reference' for c in channel_categories['reference']})
+        lane_styles = {
+            'eeg': ("μV", None),
+            'ecg': ("mV", "ECG"),
+            'reference': ("μV", "Reference"),
+        }
+        
+        # Stack channels top to bottom in a single axes, one lane per channel
+        offsets = np.arange(n_channels)[::-1]
+        
+        # Wrapped so only the visible window is downsampled and sent to the browser;
+        # per-bucket min/max keeps the waveform envelope and runs in one parallel pass
+        fig = FigureResampler(
+            go.Figure(),
+            default_downsampler=MinMaxAggregator(parallel=True),
         )
         
         # Color palette for channels
         colors = px.colors.qualitative.Set1 + px.colors.qualitative.Set2
         
+        # Look up the arrays once instead of indexing the DataFrame per channel
+        col_set = set(self.data.columns)
+        if 'Time' in col_set:
+            time_arr = self.data['Time'].values
+        else:
+            time_arr = self.time_offset + np.arange(self.n_samples) / self.sample_rate
+        arrs = {c: self.data[c].values for c in channels_to_plot if c in col_set}
+        
+        # Lane tags are collected here and applied in the single layout update
+        annotations = []
+        
         # Add traces for each channel
         for i, channel in enumerate(channels_to_plot):
-            if channel in self.data.columns:
+            if channel in col_set:
                 color = colors[i % len(colors)]
+                values = arrs[channel]
+                
+                # Robust per-channel scale: the factor 2 maps ±p99 to half a lane,
+                # so neighbouring traces rarely overlap
+                scale = 2 * np.nanpercentile(np.abs(values), 99)
+                if not np.isfinite(scale) or scale == 0:
+                    scale = 1.0
+                
+                unit, tag = lane_styles[category.get(channel, 'eeg')]
                 
                 fig.add_trace(
-                    go.Scatter(
-                        x=self.data['Time'],
-                        y=self.data[channel],
+                    go.Scattergl(
                         mode='lines',
                         name=channel,
                         line=dict(color=color),
                         hovertemplate=f'<b>{channel}</b><br>' +
                                     'Time: %{x:.4f}s<br>' +
-                                    'Amplitude: %{y:.1f}μV<extra></extra>',
+                                    f'Amplitude: %{{customdata:.1f}}{unit}<extra></extra>',
                         showlegend=False
                     ),
-                    row=i+1, col=1
+                    hf_x=time_arr,
+                    hf_y=(values / scale + offsets[i]).astype(np.float32, copy=False),
+                    hf_customdata=values,
                 )
                 
-                # Update y-axis for this subplot
-                if channel in channel_categories['ecg']:
-                    fig.update_yaxes(
-                        title_text="mV",
-                        row=i+1, col=1,
-                        showgrid=True,
-                        gridcolor='lightcoral',
-                        gridwidth=0.5,
-                        zeroline=True,
-                        zerolinecolor='black',
-                        zerolinewidth=0.5
-                    )
-                elif channel in channel_categories['reference']:
-                    fig.update_yaxes(
-                        title_text="μV (Ref)",
-                        row=i+1, col=1,
-                        showgrid=True,
-                        gridcolor='lightgray',
-                        gridwidth=0.5,
-                        zeroline=True,
-                        zerolinecolor='black',
-                        zerolinewidth=0.5
-                    )
-                else:
-                    fig.update_yaxes(
-                    title_text="μV",
-                    row=i+1, col=1,
-                    showgrid=True,
-                    gridcolor='lightblue',
-                    gridwidth=0.5,
-                    zeroline=True,
-                    zerolinecolor='blue',
-                    zerolinewidth=0.5,
-                )
+                # Tag non-EEG lanes on the right-hand side
+                if tag:
+                    annotations.append(dict(
+                        text=tag,
+                        x=1, xref='paper', xanchor='left',
+                        y=offsets[i], yref='y',
+                        showarrow=False,
+                        font=dict(color=color),
+                    ))
         
         # Update layout for better interaction
         fig.update_layout(
             title={
-                'text': f'EEG/ECG Multi-Channel <br><sub>File: {Path(self.csv_file).name} | {len(self.channels)} channels | {self.sample_rate}Hz</sub>',
+                'text': f'EEG/ECG Multi-Channel <br><sub>File: {Path(self.csv_file).name} | {len(self.channels)} channels | {self.sample_rate:g}Hz</sub>',
                 'x': 0.5,
                 'y': 0.99,
                 'yanchor': 'top',
@@ -170,19 +263,33 @@ class EEGPlotter:
                 'font': {'size': 16},
 
             },
-            height=150 * n_channels + 100,  # Dynamic height based on channels
+            height=60 * n_channels + 150,  # Dynamic height based on channels
             showlegend=False,
             hovermode='x unified',
             dragmode='pan',  # Default mode
             
             # X-axis configuration
             xaxis=dict(
+                title_text="Time (seconds)",
                 showgrid=True,
                 gridcolor='lightgray',
                 gridwidth=0.5,
                 type='linear',
             ),
             
+            # Y-axis configuration, one labelled tick per channel lane
+            yaxis=dict(
+                tickmode='array',
+                tickvals=offsets,
+                ticktext=channels_to_plot,
+                range=[-1, n_channels],
+                showgrid=True,
+                gridcolor='lightgray',
+                gridwidth=0.5,
+                zeroline=False,
+            ),
+            annotations=annotations,
+            
             # Styling
             plot_bgcolor='white',
             paper_bgcolor='white',
@@ -224,24 +331,12 @@ class EEGPlotter:
         )
 
         
-        # Configure all x-axes to be linked for zooming
-        for i in range(2, n_channels + 1):
-            fig.update_xaxes(
-                showgrid=True,
-                gridcolor='lightgray',
-                matches='x', 
-                row=i, col=1)
-            
-        fig.update_xaxes(
-            title_text="Time (seconds)",
-            row=n_channels,
-            col=1
-        )
-
-        
         return fig
     
-    def create_dash_app(self, port=8050, debug=False):
+    def create_dash_app(self):
+        import dash
+        from dash import dcc, html, Input, Output
+        
         app = dash.Dash(__name__)
      
         fig = self.create_interactive_plot()
@@ -254,6 +349,9 @@ class EEGPlotter:
             style={"marginTop": "2px"}
         )
 
+        # Re-aggregate the traces whenever the user pans or zooms
+        fig.register_update_graph_callback(app, "eeg-plot")
+
         @app.callback(
             Output("selection-output", "children"),
             Input("eeg-plot", "selectedData"),
@@ -261,7 +359,6 @@ class EEGPlotter:
         )
 
         def update_output(selected_data):
-            update_fig = fig
             if not selected_data:
                 return "No region selected."
 
@@ -272,17 +369,18 @@ class EEGPlotter:
         return app
         
     def categorize_channels(self):
-        eeg_channels = []
-        ecg_channels = []
-        reference_channels = []
-
-        for channel in self.channels:
-            if any(x in channel for x in ['X1_LEOG', 'X2_REOG']):
-                ecg_channels.append(channel)
-            elif 'CM' in channel:
-                reference_channels.append(channel)
-            else:
-                eeg_channels.append(channel)
+        import numpy as np
+        
+        arr = np.asarray(self.channels, dtype=str)
+        
+        # Boolean masks computed over all channels at once
+        is_ecg = (np.char.find(arr, 'X1_LEOG') >= 0) | (np.char.find(arr, 'X2_REOG') >= 0)
+        is_ref = (np.char.find(arr, 'CM') >= 0) & ~is_ecg
+        is_eeg = ~(is_ecg | is_ref)
+        
+        eeg_channels = arr[is_eeg].tolist()
+        ecg_channels = arr[is_ecg].tolist()
+        reference_channels = arr[is_ref].tolist()
         
         return {
             'eeg': eeg_channels,
@@ -315,7 +413,9 @@ def main():
         
         print(f"Opening plot in browser...")
         app = plotter.create_dash_app()
-        app.run(debug=True, port=8060) 
+        # Debug mode stays off: its reloader forks a second process that
+        # re-imports and re-parses everything before the first plot is served
+        app.run(debug=False, port=8060)
         
         
     except Exception as e: